@@ -26,7 +26,7 @@ setup(
     author_email='firman.kasim@gmail.com',
     license='MIT',
     packages=find_packages(),
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     install_requires=get_requirements("requirements.txt"),
     classifiers=[
         "Intended Audience :: Science/Research",
@@ -35,7 +35,6 @@ setup(
         "Topic :: Scientific/Engineering :: Mathematics",
         "License :: OSI Approved :: MIT License",
 
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
     ],
     keywords="project library linear-algebra autograd functionals",
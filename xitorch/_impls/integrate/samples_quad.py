@@ -53,8 +53,7 @@ class CubicSplineSQuad(BaseSQuad):
         xshape = x.shape
         nx = xshape[-1]
 
-        spline_mat = _get_spline_mat_inv(x, bc_type=bc_type)
-        self.spline_mat = spline_mat  # (nx, nx)
+        self.spline_mat = _get_spline_mat_inv(x, bc_type=bc_type)
         self.xshape = xshape
         self.wy = get_trapz_weights(x)  # (nx, nx)
         self.wk = get_cspline_grad_weights(x)  # (nx, nx)
@@ -63,21 +62,22 @@ class CubicSplineSQuad(BaseSQuad):
         # y: (*, nx)
         # return: (*, nx)
         y1 = y.unsqueeze(-1)  # (*, nx, 1)
-        ks = torch.matmul(self.spline_mat, y1)  # (*, nx, 1)
+        ks = self.spline_mat.apply(y).unsqueeze(-1)  # (*, nx, 1)
         kfactor = torch.matmul(self.wk, ks)  # (*, nx, 1)
         yfactor = torch.matmul(self.wy, y1)  # (*, nx, 1)
         res = kfactor + yfactor  # (*, nx)
         return res.squeeze(-1)
 
     def integrate(self, y):
-        ks = torch.matmul(self.spline_mat, y.unsqueeze(-1)).squeeze(-1)  # (*, nx)
+        ks = self.spline_mat.apply(y)  # (*, nx)
         kfactor = torch.einsum("c,...c->...", self.wk[-1], ks)
         yfactor = torch.einsum("c,...c->...", self.wy[-1], y)
         return kfactor + yfactor
 
     def getparamnames(self, methodname, prefix=""):
         if methodname == "cumsum" or methodname == "integrate":
-            return [prefix + "spline_mat", prefix + "wk", prefix + "wy"]
+            return self.spline_mat.getparamnames(prefix=prefix + "spline_mat.") + \
+                [prefix + "wk", prefix + "wy"]
         else:
             raise KeyError("%s has no %s method" % (self.__class__.__name__, methodname))
 
@@ -1,5 +1,9 @@
+import copy
+import functools
+import weakref
 import torch
 import warnings
+from typing import Tuple, Callable, Optional
 from abc import abstractmethod
 from xitorch._impls.interpolate.base_interp import BaseInterp
 from xitorch._impls.interpolate.extrap_utils import get_extrap_pos, get_extrap_val
@@ -124,60 +128,64 @@ class CubicSpline1D(BaseInterp1D):
         self.set_periodic_required(extrap == "periodic")  # or self.bc_type == "periodic"
 
         # precompute the inverse of spline matrix
-        self.spline_mat_inv = _get_spline_mat_inv(x, bc_type)  # (nr, nr)
+        self.spline_mat_inv = _get_spline_mat_inv(x, bc_type)
         self.y_is_given = y is not None
         if self.y_is_given:
             if self.is_periodic_required():
                 check_periodic_value(y)
             self.y = y
-            self.ks = torch.matmul(self.spline_mat_inv, y.unsqueeze(-1)).squeeze(-1)
+            # the spline gradients and the polynomial coefficients only
+            # depend on x and y, so they can be precomputed
+            ks = self.spline_mat_inv.apply(y)  # (*BY, nr)
+            self._coeffs = _get_spline_coeffs(x, y, ks)  # (*BY, 3, nr-1)
+            self._xl = x[..., :-1]  # (nr-1)
+            self._dx = x[..., 1:] - self._xl  # (nr-1)
+            # with the fixed knots, the evaluation can be specialized with
+            # torch.compile if available (PyTorch >= 2.0)
+            self._use_compiled = hasattr(torch, "compile") and x.is_cuda
 
     def _interp(self, xq, y):
         # https://en.wikipedia.org/wiki/Spline_interpolation#Algorithm_to_find_the_interpolating_cubic_spline
-        # get the k-vector (i.e. the gradient at every points)
-        if self.y_is_given:
-            ks = self.ks
-        else:
-            ks = torch.matmul(self.spline_mat_inv, y.unsqueeze(-1)).squeeze(-1)  # (*BY, nr)
-
         x = self.x  # (nr)
 
         # find the index location of xq
         nr = x.shape[-1]
         # detaching due to PyTorch's issue #42328
-        idxr = torch.searchsorted(x.detach(), xq.detach(), right=False)  # (nrq)
+        idxr = torch.bucketize(xq.detach(), x.detach(), right=False)  # (nrq)
         idxr = torch.clamp(idxr, 1, nr - 1)
         idxl = idxr - 1  # (nrq) from (0 to nr-2)
 
-        if torch.numel(xq) > torch.numel(x):
-            # get the variables needed
-            yl = y[..., :-1]  # (*BY, nr-1)
-            xl = x[..., :-1]  # (nr-1)
-            dy = y[..., 1:] - yl  # (*BY, nr-1)
-            dx = x[..., 1:] - xl  # (nr-1)
-            a = ks[..., :-1] * dx - dy  # (*BY, nr-1)
-            b = -ks[..., 1:] * dx + dy  # (*BY, nr-1)
-
-            # calculate the coefficients for the t-polynomial
-            p0 = yl  # (*BY, nr-1)
-            p1 = (dy + a)  # (*BY, nr-1)
-            p2 = (b - 2 * a)  # (*BY, nr-1)
-            p3 = a - b  # (*BY, nr-1)
-
-            t = (xq - torch.gather(xl, -1, idxl)) / torch.gather(dx, -1, idxl)  # (nrq)
-            # yq = p0[:,idxl] + t * (p1[:,idxl] + t * (p2[:,idxl] + t * p3[:,idxl])) # (nbatch, nrq)
-            # NOTE: lines below do not work if xq and x have batch dimensions
-            yq = p3[..., idxl] * t
-            yq += p2[..., idxl]
-            yq *= t
-            yq += p1[..., idxl]
-            yq *= t
-            yq += p0[..., idxl]
+        # get the k-vector (i.e. the gradient at every points)
+        if not self.y_is_given:
+            ks = self.spline_mat_inv.apply(y)  # (*BY, nr)
+
+        # use the polynomial coefficients if they are precomputed or if it is
+        # cheaper than evaluating only at the query points
+        if self.y_is_given or torch.numel(xq) > torch.numel(x):
+            if self.y_is_given:
+                coeffs = self._coeffs
+                xl = self._xl
+                dx = self._dx
+            else:
+                coeffs = _get_spline_coeffs(x, y, ks)  # (*BY, 3, nr-1)
+                xl = x[..., :-1]  # (nr-1)
+                dx = x[..., 1:] - xl  # (nr-1)
+
+            # the compiled kernel is only used for calls that do not require
+            # gradients as the compiled graphs do not support double backward
+            requires_grad = torch.is_grad_enabled() and \
+                any([a.requires_grad for a in (xq, y, coeffs, xl, dx)])
+            use_compiled = self.y_is_given and self._use_compiled and not requires_grad
+            if use_compiled:
+                eval_fcn = _get_compiled_eval_spline()
+            else:
+                eval_fcn = _eval_spline
+            yq = eval_fcn(xq, idxl, xl, dx, y, coeffs)  # (*BY, nrq)
             return yq
 
         else:
-            xl = torch.gather(x, -1, idxl)
-            xr = torch.gather(x, -1, idxr)
+            xl = x.index_select(-1, idxl)
+            xr = x.index_select(-1, idxr)
             yl = y[..., idxl].contiguous()
             yr = y[..., idxr].contiguous()
             kl = ks[..., idxl].contiguous()
@@ -201,9 +209,11 @@ class CubicSpline1D(BaseInterp1D):
 
     def getparamnames(self):
         if self.y_is_given:
-            res = ["x", "y", "ks"]
+            # x only enters through the (detached) search of the query
+            # segments as all its other uses are precomputed
+            res = ["y", "_coeffs", "_xl", "_dx"]
         else:
-            res = ["spline_mat_inv", "x"]
+            res = self.spline_mat_inv.getparamnames(prefix="spline_mat_inv.") + ["x"]
         return res
 
 def check_and_get_extrap(extrap, bc_type):
@@ -221,17 +231,152 @@ def check_periodic_value(y):
     if not torch.allclose(y[..., 0], y[..., -1]):
         raise RuntimeError("The value of y must be periodic to have periodic bc_type or extrap")
 
-# @torch.jit.script
-def _get_spline_mat_inv(x: torch.Tensor, bc_type: str):
+def _get_spline_coeffs(x: torch.Tensor, y: torch.Tensor, ks: torch.Tensor) -> torch.Tensor:
+    # returns the coefficients (p1, p2, p3) of the t-polynomial in every segment
+    # stacked in the second last dimension, the constant term p0 is the y
+    # at the left point of the segment
+    # x: (nr,)
+    # y, ks: (*BY, nr)
+    # returns: (*BY, 3, nr-1)
+    yl = y[..., :-1]  # (*BY, nr-1)
+    dy = y[..., 1:] - yl  # (*BY, nr-1)
+    dx = x[..., 1:] - x[..., :-1]  # (nr-1)
+    a = ks[..., :-1] * dx - dy  # (*BY, nr-1)
+    b = -ks[..., 1:] * dx + dy  # (*BY, nr-1)
+    p1 = (dy + a)  # (*BY, nr-1)
+    p2 = (b - 2 * a)  # (*BY, nr-1)
+    p3 = a - b  # (*BY, nr-1)
+    return torch.stack((p1, p2, p3), dim=-2)
+
+def _eval_spline(xq: torch.Tensor, idxl: torch.Tensor, xl: torch.Tensor,
+                 dx: torch.Tensor, y: torch.Tensor, coeffs: torch.Tensor) -> torch.Tensor:
+    # evaluate the spline at the query points from the polynomial coefficients
+    # xq: (nrq)
+    # idxl: (nrq) the index of the segment of every query point
+    # xl, dx: (nr-1) the left points and the widths of the segments
+    # y: (*BY, nr)
+    # coeffs: (*BY, 3, nr-1)
+    # returns: (*BY, nrq)
+    t = (xq - xl.index_select(-1, idxl)) / dx.index_select(-1, idxl)  # (nrq)
+    # NOTE: lines below do not work if xq and x have batch dimensions
+    p0 = y.index_select(-1, idxl)  # (*BY, nrq)
+    p1, p2, p3 = coeffs.index_select(-1, idxl).unbind(-2)  # (*BY, nrq)
+    return _horner_spline(p0, p1, p2, p3, t)
+
+@functools.lru_cache(maxsize=None)
+def _get_compiled_eval_spline() -> Callable[..., torch.Tensor]:
+    # compiled only once and shared by all the instances, the shapes are
+    # compiled as dynamic so that a new number of query points or knots does
+    # not trigger a recompilation
+    return torch.compile(_eval_spline, dynamic=True)  # type: ignore
+
+def _horner_spline(p0: torch.Tensor, p1: torch.Tensor, p2: torch.Tensor, p3: torch.Tensor,
+                   t: torch.Tensor) -> torch.Tensor:
+    # evaluate the t-polynomial p0 + p1 * t + p2 * t^2 + p3 * t^3 with one
+    # fused multiply-add kernel per Horner step
+    # p0, p1, p2, p3: (*BY, nrq)
+    # t: (nrq)
+    yq = torch.addcmul(p2, p3, t)
+    yq = torch.addcmul(p1, yq, t)
+    yq = torch.addcmul(p0, yq, t)
+    return yq
+
+def _get_tridiag_spline_mat_inv(lower: torch.Tensor, diag: torch.Tensor, upper: torch.Tensor,
+                                rlower: torch.Tensor, rdiag: torch.Tensor, rupper: torch.Tensor,
+                                rfirst: torch.Tensor, rlast: torch.Tensor) -> torch.Tensor:
+    # returns the dense inverse of the spline matrix, spline_mat^{-1} @ matr,
+    # where spline_mat has been reduced to a tridiagonal matrix, obtained with
+    # one batched solve
+    # lower, upper: (*BX, nr-1) the off-diagonals of spline_mat
+    # diag: (*BX, nr) the diagonal of spline_mat
+    # rlower, rupper: (*BX, nr-1) the off-diagonals of matr
+    # rdiag: (*BX, nr) the diagonal of matr
+    # rfirst, rlast: (*BX, 1) the elements of matr at column 2 of the first
+    #     row and at column -3 of the last row
+    # returns: (*BX, nr, nr)
+    nr = diag.shape[-1]
+    spline_mat = _get_tridiag_mat(diag, upper, lower)  # (*BX, nr, nr)
+    matr = _get_tridiag_mat(rdiag, rupper, rlower)  # (*BX, nr, nr)
+    if nr > 2:
+        matr[..., 0, 2] += rfirst[..., 0]
+        matr[..., -1, -3] += rlast[..., 0]
+    return torch.linalg.solve(spline_mat, matr)
+
+class _DenseSplineMatInv(object):
+    """
+    The inverse of the spline matrix stored as a dense matrix, so it can be
+    applied with a single matrix multiplication.
+    """
+    def __init__(self, mat: torch.Tensor):
+        # mat: (nr, nr)
+        self.mat = mat
+        # the knots this inverse is cached for and the cached inverse this
+        # object is copied from (see _get_spline_mat_inv)
+        self._x: Optional[torch.Tensor] = None
+        self._cached: Optional[_DenseSplineMatInv] = None
+
+    def apply(self, y: torch.Tensor) -> torch.Tensor:
+        # y: (*BY, nr)
+        # linear(y, A) = y @ A^T avoids broadcasting the matrix over *BY
+        return torch.nn.functional.linear(y, self.mat)
+
+    def fullmatrix(self) -> torch.Tensor:
+        return self.mat
+
+    def getparamnames(self, prefix: str = ""):
+        return [prefix + "mat"]
+
+def _get_spline_bands(x: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+    # returns the bands of the spline matrix and the matrix on the right hand
+    # side for the natural boundary condition
+    # x: (*BX, nr)
+    # returns: dxinv0 (*BX, nr-1) and the (diagonal, off-diagonal) of the
+    #     symmetric spline matrix with shape (*BX, nr) and (*BX, nr-1), and
+    #     the (diagonal, upper, lower) of the right hand side matrix with shape
+    #     (*BX, nr), (*BX, nr-1), and (*BX, nr-1)
+    dxinv0 = 1. / (x[..., 1:] - x[..., :-1])  # (*BX,nr-1)
+    zero_pad = torch.zeros_like(dxinv0[..., :1])
+    dxinv = torch.cat((zero_pad, dxinv0, zero_pad), dim=-1)
+    diag = (dxinv[..., :-1] + dxinv[..., 1:]) * 2  # (*BX,nr)
+    offdiag = dxinv0  # (*BX,nr-1)
+
+    dxinv2 = (dxinv * dxinv) * 3
+    diagr = (dxinv2[..., :-1] - dxinv2[..., 1:])  # (*BX,nr)
+    udiagr = dxinv2[..., 1:-1]  # (*BX,nr-1)
+    ldiagr = -udiagr  # (*BX,nr-1)
+    return dxinv0, diag, offdiag, diagr, udiagr, ldiagr
+
+def _get_tridiag_mat(diag: torch.Tensor, upper: torch.Tensor, lower: torch.Tensor) -> torch.Tensor:
+    # construct the dense tridiagonal matrix by writing the bands into a single
+    # zero-initialized matrix
+    # diag: (*BX, nr)
+    # upper, lower: (*BX, nr-1)
+    # returns: (*BX, nr, nr)
+    nr = diag.shape[-1]
+    mat = torch.zeros((*diag.shape[:-1], nr, nr), dtype=diag.dtype, device=diag.device)
+    mat.diagonal(dim1=-2, dim2=-1)[..., :] = diag
+    mat.diagonal(offset=1, dim1=-2, dim2=-1)[..., :] = upper
+    mat.diagonal(offset=-1, dim1=-2, dim2=-1)[..., :] = lower
+    return mat
+
+
+# cache of the spline matrix inverses, the entries are removed once the
+# objects using them are deleted
+_spline_mat_inv_cache: "weakref.WeakValueDictionary[tuple, _DenseSplineMatInv]" = \
+    weakref.WeakValueDictionary()
+
+def _get_spline_mat_inv(x: torch.Tensor, bc_type: str) -> _DenseSplineMatInv:
     """
     Returns the inverse of spline matrix where the gradient can be obtained just
     by
 
-    >>> spline_mat_inv = _get_spline_mat_inv(x, transpose=True)
-    >>> ks = torch.matmul(y, spline_mat_inv)
+    >>> spline_mat_inv = _get_spline_mat_inv(x, bc_type)
+    >>> ks = spline_mat_inv.apply(y)
 
-    where `y` is a tensor of (nbatch, nr) and `spline_mat_inv` is the output of
-    this function with shape (nr, nr)
+    where `y` is a tensor of (*BY, nr). The inverse is stored as a dense
+    matrix, which can be obtained with ``spline_mat_inv.fullmatrix()``. Except
+    for ``"periodic"`` boundary condition, it is solved from the spline matrix
+    after it is reduced to a tridiagonal matrix.
 
     Arguments
     ---------
@@ -242,42 +387,128 @@ def _get_spline_mat_inv(x: torch.Tensor, bc_type: str):
 
     Returns
     -------
-    mat: torch.Tensor with shape (*BX, nr, nr)
+    _DenseSplineMatInv
         The inverse of spline matrix.
+
+    Note
+    ----
+    If ``x`` does not require gradients and is not an inference tensor, the
+    inverse is cached and reused for the following calls with the same
+    unmodified ``x`` tensor as long as an object returned for it is still
+    alive.
     """
-    nr = x.shape[-1]
-    BX = x.shape[:-1]
-    matshape = (*BX, nr, nr)
+    # inference tensors do not track their version counter, so in-place
+    # modifications cannot be detected
+    if x.requires_grad or x.is_inference():
+        return _calc_spline_mat_inv(x, bc_type)
+
+    # x._version is increased by in-place operations on x
+    key = (x.data_ptr(), tuple(x.shape), tuple(x.stride()), str(x.dtype),
+           str(x.device), x._version, bc_type)
+    mat_inv = _spline_mat_inv_cache.get(key, None)
+    if mat_inv is None:
+        mat_inv = _calc_spline_mat_inv(x, bc_type)
+        # keep x alive so its memory cannot be reused by another tensor with
+        # the same data_ptr while the entry is in the cache
+        mat_inv._x = x
+        _spline_mat_inv_cache[key] = mat_inv
+
+    # every caller gets its own shallow copy as the tensors can be replaced
+    # with setparams, the copy also keeps the cache entry alive
+    res = copy.copy(mat_inv)
+    res._cached = mat_inv
+    return res
+
+def _calc_spline_mat_inv(x: torch.Tensor, bc_type: str) -> _DenseSplineMatInv:
+    # construct the spline matrix inverse (see _get_spline_mat_inv)
+    if bc_type == "periodic":
+        return _DenseSplineMatInv(_get_dense_spline_mat_inv(x, bc_type))
+
+    # the tridiagonal elements of the matrices for the left and right hand sides
+    dxinv0, diag, lower, rdiag, rupper, rlower = _get_spline_bands(x)
+    upper = lower
+    zero_pad = torch.zeros_like(dxinv0[..., :1])
+    rfirst = zero_pad
+    rlast = zero_pad
 
-    device = x.device
-    dtype = x.dtype
+    # modify the first and the last rows according to the boundary conditions
+    if bc_type == "natural":
+        pass  # set to be natural
+    elif bc_type == "clamped":
+        one_pad = torch.ones_like(zero_pad)
+        diag = torch.cat((one_pad, diag[..., 1:-1], one_pad), dim=-1)
+        upper = torch.cat((zero_pad, upper[..., 1:]), dim=-1)
+        lower = torch.cat((lower[..., :-1], zero_pad), dim=-1)
+        rdiag = torch.cat((zero_pad, rdiag[..., 1:-1], zero_pad), dim=-1)
+        rupper = torch.cat((zero_pad, rupper[..., 1:]), dim=-1)
+        rlower = torch.cat((rlower[..., :-1], zero_pad), dim=-1)
+    elif bc_type == "not-a-knot":
+        if x.shape[-1] < 4:
+            raise RuntimeError("not-a-knot bc_type requires at least 4 points")
+        dxinv00_sq = dxinv0[..., :1]**2
+        dxinv01_sq = dxinv0[..., 1:2]**2
+        dxinv0n_sq = dxinv0[..., -1:]**2
+        dxinv0nm1_sq = dxinv0[..., -2:-1]**2
+        dxinv00_3 = dxinv0[..., :1] * dxinv00_sq
+        dxinv01_3 = dxinv0[..., 1:2] * dxinv01_sq
+        dxinv0n_3 = dxinv0[..., -1:] * dxinv0n_sq
+        dxinv0nm1_3 = dxinv0[..., -2:-1] * dxinv0nm1_sq
+
+        # the first row has non-zero elements at columns 0, 1, 2 and the
+        # last row at columns -3, -2, -1. The elements at column 2 and -3 are
+        # eliminated using the second and the second last rows to make the
+        # matrix tridiagonal.
+        # first row: (row0 - f0 * row1) with f0 = s02 / upper[1]
+        f0 = -dxinv0[..., 1:2]
+        diag0 = dxinv00_sq - f0 * lower[..., :1]
+        upper0 = (dxinv00_sq - dxinv01_sq) - f0 * diag[..., 1:2]
+        rdiag0 = 2 * (-dxinv00_3) - f0 * rlower[..., :1]
+        rupper0 = 2 * (dxinv00_3 + dxinv01_3) - f0 * rdiag[..., 1:2]
+        rfirst = 2 * (-dxinv01_3) - f0 * rupper[..., 1:2]
+        # last row: (row-1 - fn * row-2) with fn = s(-1,-3) / lower[-2]
+        fn = dxinv0[..., -2:-1]
+        diagn = -dxinv0n_sq - fn * upper[..., -1:]
+        lowern = (dxinv0nm1_sq - dxinv0n_sq) - fn * diag[..., -2:-1]
+        rdiagn = 2 * (-dxinv0n_3) - fn * rupper[..., -1:]
+        rlowern = 2 * (dxinv0n_3 + dxinv0nm1_3) - fn * rdiag[..., -2:-1]
+        rlast = 2 * (-dxinv0nm1_3) - fn * rlower[..., -2:-1]
+
+        diag = torch.cat((diag0, diag[..., 1:-1], diagn), dim=-1)
+        upper = torch.cat((upper0, upper[..., 1:]), dim=-1)
+        lower = torch.cat((lower[..., :-1], lowern), dim=-1)
+        rdiag = torch.cat((rdiag0, rdiag[..., 1:-1], rdiagn), dim=-1)
+        rupper = torch.cat((rupper0, rupper[..., 1:]), dim=-1)
+        rlower = torch.cat((rlower[..., :-1], rlowern), dim=-1)
+    else:
+        raise RuntimeError("Unknown boundary condition: %s" % bc_type)
 
-    # construct the matrix for the left hand side
-    dxinv0 = 1. / (x[..., 1:] - x[..., :-1])  # (*BX,nr-1)
-    zero_pad = torch.zeros_like(dxinv0[..., :1])
-    dxinv = torch.cat((zero_pad, dxinv0, zero_pad), dim=-1)
-    diag = (dxinv[..., :-1] + dxinv[..., 1:]) * 2  # (*BX,nr)
-    offdiag = dxinv0  # (*BX,nr-1)
-    spline_mat = torch.zeros(matshape, dtype=dtype, device=device)
-    spdiag = spline_mat.diagonal(dim1=-2, dim2=-1)  # (*BX, nr)
-    spudiag = spline_mat.diagonal(offset=1, dim1=-2, dim2=-1)
-    spldiag = spline_mat.diagonal(offset=-1, dim1=-2, dim2=-1)
-    spdiag[..., :] = diag
-    spudiag[..., :] = offdiag
-    spldiag[..., :] = offdiag
-
-    # construct the matrix on the right hand side
-    dxinv2 = (dxinv * dxinv) * 3
-    diagr = (dxinv2[..., :-1] - dxinv2[..., 1:])
-    udiagr = dxinv2[..., 1:-1]
-    ldiagr = -udiagr
-    matr = torch.zeros(matshape, dtype=dtype, device=device)
-    matrdiag = matr.diagonal(dim1=-2, dim2=-1)
-    matrudiag = matr.diagonal(offset=1, dim1=-2, dim2=-1)
-    matrldiag = matr.diagonal(offset=-1, dim1=-2, dim2=-1)
-    matrdiag[..., :] = diagr
-    matrudiag[..., :] = udiagr
-    matrldiag[..., :] = ldiagr
+    # the inverse is solved only once here, so applying it is a single matrix
+    # multiplication
+    mat = _get_tridiag_spline_mat_inv(lower, diag, upper, rlower, rdiag, rupper, rfirst, rlast)
+    return _DenseSplineMatInv(mat)
+
+# @torch.jit.script
+def _get_dense_spline_mat_inv(x: torch.Tensor, bc_type: str):
+    """
+    Returns the dense inverse of spline matrix with shape (*BX, nr, nr),
+    obtained by solving the spline matrix explicitly.
+
+    Arguments
+    ---------
+    x: torch.Tensor with shape (*BX, nr)
+        The x-position of the data
+    bc_type: str
+        The boundary condition
+
+    Returns
+    -------
+    mat: torch.Tensor with shape (*BX, nr, nr)
+        The inverse of spline matrix.
+    """
+    # construct the matrices for the left and right hand sides from their bands
+    dxinv0, diag, offdiag, diagr, udiagr, ldiagr = _get_spline_bands(x)
+    spline_mat = _get_tridiag_mat(diag, offdiag, offdiag)  # (*BX, nr, nr)
+    matr = _get_tridiag_mat(diagr, udiagr, ldiagr)  # (*BX, nr, nr)
 
     # modify the matrices according to the boundary conditions
     if bc_type == "natural":
@@ -328,7 +559,7 @@ def _get_spline_mat_inv(x: torch.Tensor, bc_type: str):
         raise RuntimeError("Unknown boundary condition: %s" % bc_type)
 
     # solve the matrix inverse
-    spline_mat_inv, _ = torch.solve(matr, spline_mat)
+    spline_mat_inv = torch.linalg.solve(spline_mat, matr)
 
     # return to the shape of x
     return spline_mat_inv
@@ -336,20 +336,23 @@ def exactsolve(A: LinearOperator, B: torch.Tensor,
     # M: (*BM, na, na)
     if E is None:
         Amatrix = A.fullmatrix()  # (*BA, na, na)
-        x, _ = torch.solve(B, Amatrix)  # (*BAB, na, ncols)
+        x = torch.linalg.solve(Amatrix, B)  # (*BAB, na, ncols)
     elif M is None:
         Amatrix = A.fullmatrix()
         x = _solve_ABE(Amatrix, B, E)
     else:
+        Amatrix = A.fullmatrix()  # (*BA, na, na)
         Mmatrix = M.fullmatrix()  # (*BM, na, na)
-        L = torch.cholesky(Mmatrix, upper=False)  # (*BM, na, na)
-        Linv = torch.inverse(L)  # (*BM, na, na)
-        LinvT = Linv.transpose(-2, -1)  # (*BM, na, na)
-        A2 = torch.matmul(Linv, A.mm(LinvT))  # (*BAM, na, na)
-        B2 = torch.matmul(Linv, B)  # (*BBM, na, ncols)
+        L = torch.linalg.cholesky(Mmatrix)  # (*BM, na, na)
+        # A2 = L^{-1} A L^{-T} and B2 = L^{-1} B with triangular solves
+        # instead of explicitly inverting L
+        LinvA = torch.linalg.solve_triangular(L, Amatrix, upper=False)  # (*BAM, na, na)
+        A2 = torch.linalg.solve_triangular(L, LinvA.transpose(-2, -1), upper=False)  # (*BAM, na, na)
+        A2 = A2.transpose(-2, -1)
+        B2 = torch.linalg.solve_triangular(L, B, upper=False)  # (*BBM, na, ncols)
 
         X2 = _solve_ABE(A2, B2, E)  # (*BABEM, na, ncols)
-        x = torch.matmul(LinvT, X2)  # (*BABEM, na, ncols)
+        x = torch.linalg.solve_triangular(L.transpose(-2, -1), X2, upper=True)  # (*BABEM, na, ncols)
     return x
 
 def _solve_ABE(A: torch.Tensor, B: torch.Tensor, E: torch.Tensor):
@@ -363,7 +366,7 @@ def _solve_ABE(A: torch.Tensor, B: torch.Tensor, E: torch.Tensor):
 
     # NOTE: The line below is very inefficient for large na and ncols
     AE = A - torch.diag_embed(E.repeat_interleave(repeats=na, dim=-1), dim1=-2, dim2=-1)  # (ncols, *BAE, na, na)
-    r, _ = torch.solve(B, AE)  # (ncols, *BAEM, na, 1)
+    r = torch.linalg.solve(AE, B)  # (ncols, *BAEM, na, 1)
     r = r.transpose(0, -1).squeeze(0)  # (*BAEM, na, ncols)
     return r
 
@@ -1,4 +1,5 @@
-import functools
+import numpy as np
+import scipy.linalg
 import torch
 from xitorch import LinearOperator
 from typing import Union, Optional, Tuple, Sequence
@@ -17,26 +18,90 @@ def exacteig(A: LinearOperator, neig: int,
       a large memory.
     """
     Amatrix = A.fullmatrix()  # (*BA, q, q)
-    if M is None:
-        evals, evecs = torch.symeig(Amatrix, eigenvectors=True)  # (*BA, q), (*BA, q, q)
-        return _take_eigpairs(evals, evecs, neig, mode)
+    Mmatrix = M.fullmatrix() if M is not None else None  # (*BM, q, q)
+    q = Amatrix.shape[-1]
+
+    # only compute the requested eigenpairs with LAPACK if there are much fewer
+    # of them than the size of the matrix, otherwise the batched torch
+    # eigensolver is faster than looping over the batch with scipy
+    partial = neig < q // 4
+    if partial and _is_lapack_eigh_applicable(Amatrix, Mmatrix):
+        subset = (0, neig - 1) if mode == "lowest" else (q - neig, q - 1)
+        return _lapack_eigh(Amatrix, Mmatrix, subset=subset)  # (*BAM, neig) and (*BAM, q, neig)
+    elif Mmatrix is None:
+        evals, evecs = _batched_symeig(Amatrix)  # (*BA, q), (*BA, q, q)
+    else:
+        evals, evecs = _generalized_eigh(Amatrix, Mmatrix)  # (*BAM, q) and (*BAM, q, q)
+    return _take_eigpairs(evals, evecs, neig, mode)
+
+def _is_lapack_eigh_applicable(Amatrix: torch.Tensor, Mmatrix: Optional[torch.Tensor]) -> bool:
+    # LAPACK's eigensolvers via scipy can only be used for CPU tensors that do
+    # not need to propagate the gradients
+    mats = [Amatrix] if Mmatrix is None else [Amatrix, Mmatrix]
+    require_grad = torch.is_grad_enabled() and any([mat.requires_grad for mat in mats])
+    return not require_grad and all([mat.device.type == "cpu" for mat in mats])
+
+def _lapack_eigh(Amatrix: torch.Tensor, Mmatrix: Optional[torch.Tensor],
+                 subset: Optional[Tuple[int, int]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    # solve the (generalized) eigenvalue problem AX = MXE with LAPACK via
+    # scipy (syevr/sygvx if only a subset of eigenpairs is requested)
+    # Amatrix: (*BA, q, q)
+    # Mmatrix: (*BM, q, q) or None
+    # subset: the (lowest, highest) indices of the eigenpairs to be computed,
+    #     or None to compute all of them
+    # returns the eigenvalues (*BAM, neig) sorted from the lowest and the
+    # eigenvectors (*BAM, q, neig) normalized in M-space
+    q = Amatrix.shape[-1]
+    neig = q if subset is None else subset[1] - subset[0] + 1
+    if Mmatrix is None:
+        bcast_dims = Amatrix.shape[:-2]
     else:
-        Mmatrix = M.fullmatrix()  # (*BM, q, q)
-
-        # M decomposition to make A symmetric
-        # it is done this way to make it numerically stable in avoiding
-        # complex eigenvalues for (near-)degenerate case
-        L = torch.cholesky(Mmatrix, upper=False)  # (*BM, q, q)
-        Linv = torch.inverse(L)  # (*BM, q, q)
-        LinvT = Linv.transpose(-2, -1)  # (*BM, q, q)
-        A2 = torch.matmul(Linv, torch.matmul(Amatrix, LinvT))  # (*BAM, q, q)
-
-        # calculate the eigenvalues and eigenvectors
-        # (the eigvecs are normalized in M-space)
-        evals, evecs = torch.symeig(A2, eigenvectors=True)  # (*BAM, q, q)
-        evals, evecs = _take_eigpairs(evals, evecs, neig, mode)  # (*BAM, neig) and (*BAM, q, neig)
-        evecs = torch.matmul(LinvT, evecs)
-        return evals, evecs
+        bcast_dims = get_bcasted_dims(Amatrix.shape[:-2], Mmatrix.shape[:-2])
+    Anp = Amatrix.expand(*bcast_dims, q, q).reshape(-1, q, q).detach().numpy()
+    Mnp = Mmatrix.expand(*bcast_dims, q, q).reshape(-1, q, q).detach().numpy() \
+        if Mmatrix is not None else None
+    evals_np = np.empty((Anp.shape[0], neig), dtype=Anp.dtype)
+    evecs_np = np.empty((Anp.shape[0], q, neig), dtype=Anp.dtype)
+    for i in range(Anp.shape[0]):
+        Mnp_i = Mnp[i] if Mnp is not None else None
+        evals_np[i], evecs_np[i] = scipy.linalg.eigh(Anp[i], Mnp_i, lower=False,
+                                                     subset_by_index=subset)
+    evals = torch.from_numpy(evals_np).reshape(*bcast_dims, neig)
+    evecs = torch.from_numpy(evecs_np).reshape(*bcast_dims, q, neig)
+    return evals, evecs
+
+def _batched_symeig(mat: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # torch.linalg.eigh with all the batch dimensions stacked in one contiguous
+    # (nbatch, q, q) tensor, as expected by the batched eigensolvers
+    # mat: (*BA, q, q)
+    # returns the eigenvalues (*BA, q) and the eigenvectors (*BA, q, q)
+    batch_dims = mat.shape[:-2]
+    q = mat.shape[-1]
+    evals, evecs = torch.linalg.eigh(mat.reshape(-1, q, q).contiguous(), UPLO="U")
+    return evals.reshape(*batch_dims, q), evecs.reshape(*batch_dims, q, q)
+
+def _generalized_eigh(Amatrix: torch.Tensor, Mmatrix: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # solve the generalized eigenvalue problem AX = MXE with differentiable
+    # torch operations
+    # Amatrix: (*BA, q, q)
+    # Mmatrix: (*BM, q, q)
+    # returns the eigenvalues (*BAM, q) sorted from the lowest and the
+    # eigenvectors (*BAM, q, q) normalized in M-space
+
+    # M decomposition to make A symmetric
+    # it is done this way to make it numerically stable in avoiding
+    # complex eigenvalues for (near-)degenerate case
+    # A2 = L^{-1} A L^{-T} is obtained with triangular solves from both sides
+    # without constructing L^{-1} explicitly
+    L = torch.linalg.cholesky(Mmatrix)  # (*BM, q, q)
+    LinvA = torch.linalg.solve_triangular(L, Amatrix, upper=False)  # (*BAM, q, q)
+    A2 = torch.linalg.solve_triangular(L, LinvA.transpose(-2, -1), upper=False).transpose(-2, -1)  # (*BAM, q, q)
+
+    # calculate the eigenvalues and eigenvectors
+    # (the eigvecs are normalized in M-space)
+    evals, evecs = _batched_symeig(A2)  # (*BAM, q, q)
+    evecs = torch.linalg.solve_triangular(L.transpose(-2, -1), evecs, upper=True)
+    return evals, evecs
 
 def davidson(A: LinearOperator, neig: int,
              mode: str,
@@ -102,17 +167,18 @@ def davidson(A: LinearOperator, neig: int,
 
     best_resid: Union[float, torch.Tensor] = float("inf")
     AV = A.mm(V)
+    # MV is kept updated together with V and AV, so M is only applied on the
+    # new guess vectors in every iteration
+    MV = M.mm(V) if M is not None else None
     for i in range(max_niter):
         VT = V.transpose(-2, -1)  # (*BAM,nguess,na)
-        # Can be optimized by saving AV from the previous iteration and only
-        # operate AV for the new V. This works because the old V has already
-        # been orthogonalized, so it will stay the same
-        # AV = A.mm(V) # (*BAM,na,nguess)
+        # AV is updated together with V at the end of every iteration, so
+        # there is no need to apply A on the whole V here
         T = torch.matmul(VT, AV)  # (*BAM,nguess,nguess)
 
         # eigvals are sorted from the lowest
         # eval: (*BAM, nguess), evec: (*BAM, nguess, nguess)
-        eigvalT, eigvecT = torch.symeig(T, eigenvectors=True)
+        eigvalT, eigvecT = torch.linalg.eigh(T, UPLO="U")
         eigvalT, eigvecT = _take_eigpairs(eigvalT, eigvecT, neig, mode)  # (*BAM, neig) and (*BAM, nguess, neig)
 
         # calculate the eigenvectors of A
@@ -120,9 +186,10 @@ def davidson(A: LinearOperator, neig: int,
 
         # calculate the residual
         AVs = torch.matmul(AV, eigvecT)  # (*BAM, na, neig)
-        LVs = eigvalT.unsqueeze(-2) * eigvecA  # (*BAM, na, neig)
-        if M is not None:
-            LVs = M.mm(LVs)
+        if MV is not None:
+            LVs = eigvalT.unsqueeze(-2) * torch.matmul(MV, eigvecT)  # (*BAM, na, neig)
+        else:
+            LVs = eigvalT.unsqueeze(-2) * eigvecA  # (*BAM, na, neig)
         resid = AVs - LVs  # (*BAM, na, neig)
 
         # print information and check convergence
@@ -149,24 +216,74 @@ def davidson(A: LinearOperator, neig: int,
 
         # orthogonalize t with the rest of the V
         t = to_fortran_order(t)
-        Vnew = torch.cat((V, t), dim=-1)
-        if Vnew.shape[-1] > Vnew.shape[-2]:
-            Vnew = Vnew[..., :Vnew.shape[-2]]
-        nadd = Vnew.shape[-1] - V.shape[-1]
-        nguess = nguess + nadd
-        if M is not None:
-            MV_ = M.mm(Vnew)
-            V, R = tallqr(Vnew, MV=MV_)
-        else:
-            V, R = tallqr(Vnew)
-        AVnew = A.mm(V[..., -nadd:])  # (*BAM,na,nadd)
-        AVnew = to_fortran_order(AVnew)
-        AV = torch.cat((AV, AVnew), dim=-1)
+        V, AV, MV = _add_guess_vectors(A, V, AV, t, M=M, MV=MV)
+        nguess = V.shape[-1]
 
     eigvals = best_eigvals  # (*BAM, neig)
     eigvecs = best_eigvecs  # (*BAM, na, neig)
     return eigvals, eigvecs
 
+def _add_guess_vectors(A: LinearOperator, V: torch.Tensor, AV: torch.Tensor,
+                       t: torch.Tensor,
+                       M: Optional[LinearOperator] = None,
+                       MV: Optional[torch.Tensor] = None) -> \
+        Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+    # add the new guesses t to the collected vectors V and update AV and MV
+    # accordingly
+    # V: (*BAM, na, nguess) the (M-)orthonormalized collected vectors
+    # AV: (*BAM, na, nguess) A applied on V
+    # t: (*BAM, na, nadd) the new guesses
+    # MV: (*BAM, na, nguess) M applied on V, calculated here if M is given
+    #     but MV is None
+    # returns the new V, AV, and MV (None if M is None) with shape
+    # (*BAM, na, nguess + nadd)
+    nadd = min(t.shape[-1], V.shape[-2] - V.shape[-1])
+    t = t[..., :nadd]
+    if M is not None:
+        if MV is None:
+            MV = M.mm(V)
+        t, Mt = _incremental_qr(V, t, MV=MV, Mt=M.mm(t))
+        assert Mt is not None  # Mt is always returned if it is given
+        MV = torch.cat((MV, Mt), dim=-1)
+    else:
+        t, _ = _incremental_qr(V, t)
+
+    # the old V is left untouched, so AV only needs to be extended with the
+    # new vectors
+    AVnew = A.mm(t)  # (*BAM,na,nadd)
+    AV = torch.cat((AV, AVnew), dim=-1)
+    V = torch.cat((V, t), dim=-1)
+    return V, AV, MV
+
+def _incremental_qr(V: torch.Tensor, t: torch.Tensor,
+                    MV: Optional[torch.Tensor] = None,
+                    Mt: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    # orthonormalize the new columns t against the (M-)orthonormal columns of V
+    # using block Gram-Schmidt with reorthogonalization
+    # V: (*BV, na, nguess)
+    # t: (*BT, na, nadd)
+    # MV: (*BMV, na, nguess) M applied on V, if None, then M=I
+    # Mt: (*BMt, na, nadd) M applied on t, must be given if MV is given
+    # returns the orthonormalized t and its M-product (None if M=I)
+    if MV is None:
+        MV = V
+    VT = MV.transpose(-2, -1)  # (*BMV, nguess, na)
+
+    # orthogonalize twice to recover the orthogonality lost in the first pass
+    for _ in range(2):
+        coeffs = torch.matmul(VT, t)  # (*BVT, nguess, nadd)
+        t = t - torch.matmul(V, coeffs)
+        if Mt is not None:
+            Mt = Mt - torch.matmul(MV, coeffs)
+
+    # normalize the new columns
+    if Mt is None:
+        t, _ = torch.linalg.qr(t, mode="reduced")
+    else:
+        t, R = tallqr(t, MV=Mt)
+        Mt = torch.linalg.solve_triangular(R, Mt, upper=True, left=False)
+    return t, Mt
+
 def _set_initial_v(vinit_type: str,
                    dtype: torch.dtype, device: torch.device,
                    batch_dims: Sequence,
@@ -176,9 +293,12 @@ def _set_initial_v(vinit_type: str,
 
     torch.manual_seed(12421)
     if vinit_type == "eye":
-        nbatch = functools.reduce(lambda x, y: x * y, batch_dims, 1)
-        V = torch.eye(na, nguess, dtype=dtype, device=device).unsqueeze(
-            0).repeat(nbatch, 1, 1).reshape(*batch_dims, na, nguess)
+        V = torch.eye(na, nguess, dtype=dtype, device=device).expand(
+            *batch_dims, na, nguess).contiguous()
+        # the identity columns are already orthonormal as long as there are
+        # no zero columns
+        if M is None and nguess <= na:
+            return V
     elif vinit_type == "randn":
         V = torch.randn((*batch_dims, na, nguess), dtype=dtype, device=device)
     elif vinit_type == "random" or vinit_type == "rand":
@@ -1,7 +1,11 @@
+import time
 import warnings
+import pytest
 import torch
 from torch.autograd import gradcheck, gradgradcheck
 from xitorch.interpolate.interp1 import Interp1D
+from xitorch._impls.interpolate.interp_1d import _get_spline_mat_inv, _get_dense_spline_mat_inv, \
+    _calc_spline_mat_inv, _get_compiled_eval_spline
 from xitorch._tests.utils import device_dtype_float_test
 
 @device_dtype_float_test(only64=True, additional_kwargs={
@@ -138,6 +142,119 @@ def test_interp1_cspline(dtype, device, bc_type, scramble):
     gradgradcheck(interp, (x, y2, xq1))
     gradgradcheck(interp, (x, y2, xq2))
 
+@device_dtype_float_test(only64=True, additional_kwargs={
+    "bc_type": ["clamped", "natural", "not-a-knot", "periodic"],
+    "nr": [4, 20, 200],
+})
+def test_spline_mat_inv(dtype, device, bc_type, nr):
+    # check the spline matrix inverse from the tridiagonal solve against the
+    # dense solve
+    dtype_device_kwargs = {"dtype": dtype, "device": device}
+    torch.manual_seed(123)
+    x = torch.cumsum(torch.rand(nr, **dtype_device_kwargs) + 0.1, dim=-1)
+    y = torch.rand((3, 2, nr), **dtype_device_kwargs)
+
+    spline_mat_inv = _get_spline_mat_inv(x, bc_type)
+    dense_mat_inv = _get_dense_spline_mat_inv(x, bc_type)
+    assert torch.allclose(spline_mat_inv.fullmatrix(), dense_mat_inv)
+    assert torch.allclose(spline_mat_inv.apply(y), torch.matmul(dense_mat_inv, y.unsqueeze(-1)).squeeze(-1))
+
+    # batched x
+    xb = torch.stack((x, x * 2), dim=0)  # (2, nr)
+    assert torch.allclose(_get_spline_mat_inv(xb, bc_type).fullmatrix(),
+                          _get_dense_spline_mat_inv(xb, bc_type))
+
+@device_dtype_float_test(only64=True, onlycpu=True, additional_kwargs={
+    "bc_type": ["clamped", "natural", "not-a-knot"],
+    "nr": [20, 200, 1000],
+})
+def test_spline_mat_inv_speed(dtype, device, bc_type, nr):
+    # constructing the inverse must not be slower than the dense solve
+    dtype_device_kwargs = {"dtype": dtype, "device": device}
+    torch.manual_seed(123)
+    x = torch.cumsum(torch.rand(nr, **dtype_device_kwargs) + 0.1, dim=-1)
+
+    def best_time(fcn):
+        times = []
+        for _ in range(5):
+            t0 = time.perf_counter()
+            fcn()
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    # the cache is bypassed to time the construction
+    t_spline = best_time(lambda: _calc_spline_mat_inv(x, bc_type))
+    t_dense = best_time(lambda: _get_dense_spline_mat_inv(x, bc_type))
+    # with some slack to avoid failing on timing noise
+    assert t_spline <= 3 * t_dense + 1e-3
+
+def test_spline_mat_inv_not_a_knot_err():
+    x = torch.tensor([0.0, 0.4, 1.0], dtype=torch.float64)
+    try:
+        _get_spline_mat_inv(x, "not-a-knot")
+        assert False, "A RuntimeError must be raised for not-a-knot with fewer than 4 points"
+    except RuntimeError:
+        pass
+
+@device_dtype_float_test(only64=True)
+def test_spline_mat_inv_cache(dtype, device):
+    # check the spline matrix inverse is reused only for the same unmodified x
+    dtype_device_kwargs = {"dtype": dtype, "device": device}
+    torch.manual_seed(123)
+    x = torch.cumsum(torch.rand(20, **dtype_device_kwargs) + 0.1, dim=-1)
+
+    mat_inv1 = _get_spline_mat_inv(x, "natural")
+    mat_inv2 = _get_spline_mat_inv(x, "natural")
+    assert mat_inv1 is not mat_inv2
+    assert mat_inv1.mat is mat_inv2.mat
+    assert _get_spline_mat_inv(x, "clamped").mat is not mat_inv1.mat
+    assert _get_spline_mat_inv(x.clone(), "natural").mat is not mat_inv1.mat
+
+    # modifying x in-place must not return the stale inverse
+    x[1:] += 0.05
+    mat_inv3 = _get_spline_mat_inv(x, "natural")
+    assert mat_inv3.mat is not mat_inv1.mat
+    assert torch.allclose(mat_inv3.fullmatrix(), _get_dense_spline_mat_inv(x, "natural"))
+
+    # no caching if x requires gradients
+    x = x.requires_grad_()
+    assert _get_spline_mat_inv(x, "natural").mat is not _get_spline_mat_inv(x, "natural").mat
+
+@device_dtype_float_test(only64=True)
+def test_interp1_inference_mode(dtype, device):
+    # inference tensors bypass the cache of the spline matrix inverse
+    dtype_device_kwargs = {"dtype": dtype, "device": device}
+    torch.manual_seed(123)
+    x = torch.cumsum(torch.rand(20, **dtype_device_kwargs) + 0.1, dim=-1)
+    y = torch.rand((3, 20), **dtype_device_kwargs)
+    xq = torch.rand(7, **dtype_device_kwargs) * (x[-1] - x[0]) + x[0]
+    yq_true = Interp1D(x, y, method="cspline")(xq)
+    with torch.inference_mode():
+        xinf = x.clone()
+        yinf = y.clone()
+        yq = Interp1D(xinf, yinf, method="cspline")(xq)
+        assert _get_spline_mat_inv(xinf, "natural").mat is not _get_spline_mat_inv(xinf, "natural").mat
+    assert torch.allclose(yq, yq_true)
+
+@pytest.mark.skipif(not hasattr(torch, "compile"), reason="torch.compile requires PyTorch >= 2.0")
+@device_dtype_float_test(only64=True)
+def test_interp1_compiled(dtype, device):
+    # check the compiled evaluation against the eager one for several numbers
+    # of the query points
+    dtype_device_kwargs = {"dtype": dtype, "device": device}
+    torch.manual_seed(123)
+    x = torch.cumsum(torch.rand(20, **dtype_device_kwargs) + 0.1, dim=-1)
+    y = torch.rand((3, 20), **dtype_device_kwargs)
+    interp = Interp1D(x, y, method="cspline")
+    interp_compiled = Interp1D(x, y, method="cspline")
+    interp_compiled.obj._use_compiled = True  # also use it on CPU
+
+    with torch.no_grad():
+        for nrq in [7, 13, 40]:
+            xq = torch.rand(nrq, **dtype_device_kwargs) * (x[-1] - x[0]) + x[0]
+            assert torch.allclose(interp_compiled(xq), interp(xq))
+    assert _get_compiled_eval_spline.cache_info().currsize == 1
+
 @device_dtype_float_test(only64=True)
 def test_interp1_editable_module(dtype, device):
     dtype_device_kwargs = {"dtype": dtype, "device": device}
@@ -145,6 +262,7 @@ def test_interp1_editable_module(dtype, device):
     y = torch.tensor([[1.0, 1.5, 2.1, 1.1, 2.3, 2.5],
                       [0.8, 1.2, 2.2, 0.4, 3.2, 1.2]], **dtype_device_kwargs).requires_grad_()
     xq = torch.linspace(0, 1, 10, **dtype_device_kwargs).requires_grad_()
+    xq2 = torch.linspace(0, 1, 4, **dtype_device_kwargs).requires_grad_()
 
     methods = ["cspline"]
     for method in methods:
@@ -154,6 +272,9 @@ def test_interp1_editable_module(dtype, device):
             warnings.simplefilter("error")
             cls1.assertparams(cls1.__call__, xq)
             cls2.assertparams(cls2.__call__, xq, y)
+            # fewer query points than the knots
+            cls1.assertparams(cls1.__call__, xq2)
+            cls2.assertparams(cls2.__call__, xq2, y)
 
 @device_dtype_float_test(only64=True)
 def test_extrap(dtype, device):
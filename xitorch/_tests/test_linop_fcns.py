@@ -3,6 +3,7 @@ from torch.autograd import gradcheck, gradgradcheck
 from xitorch import LinearOperator
 from xitorch.linalg.symeig import lsymeig, symeig, svd
 from xitorch.linalg.solve import solve
+from xitorch._impls.linalg.symeig import _add_guess_vectors, _set_initial_v
 from xitorch._utils.bcast import get_bcasted_dims
 from xitorch._tests.utils import device_dtype_float_test
 
@@ -46,11 +47,13 @@ def test_lsymeig_mismatch_err(dtype, device):
 
 
 @device_dtype_float_test(only64=True, additional_kwargs={
-    "shape": [(4, 4), (2, 4, 4), (2, 3, 4, 4)],
     "method": ["exacteig", "custom_exacteig"],  # only 2 of methods, because both gradient implementations are covered
 })
-def test_lsymeig_A(dtype, device, shape, method):
+def test_lsymeig_A(dtype, device, method):
+    # the unbatched and smaller batched cases are covered as the slices of
+    # the batched one, so the gradcheck only has to be done once
     torch.manual_seed(seed)
+    shape = (2, 3, 4, 4)
     mat1 = torch.rand(shape, dtype=dtype, device=device)
     mat1 = mat1 + mat1.transpose(-2, -1)
     mat1 = mat1.requires_grad_()
@@ -63,27 +66,36 @@ def test_lsymeig_A(dtype, device, shape, method):
         assert list(eigvals.shape) == list([*linop1.shape[:-2], neig])
 
         ax = linop1.mm(eigvecs)
-        xe = torch.matmul(eigvecs, torch.diag_embed(eigvals, dim1=-2, dim2=-1))
+        xe = eigvecs * eigvals.unsqueeze(-2)
         assert torch.allclose(ax, xe)
 
-        # only perform gradcheck if neig is full, to reduce the computational cost
-        if neig == shape[-1]:
-            def lsymeig_fcn(amat):
-                amat = (amat + amat.transpose(-2, -1)) * 0.5  # symmetrize
-                alinop = LinearOperator.m(amat, is_hermitian=True)
-                eigvals_, eigvecs_ = lsymeig(alinop, neig=neig, **fwd_options)
-                return eigvals_, eigvecs_
+        # compare with the lower rank batched matrices
+        for submat, subeigvals in [(mat1[1, 2], eigvals[1, 2]), (mat1[1], eigvals[1])]:
+            eigvals2, eigvecs2 = lsymeig(LinearOperator.m(submat, True), neig=neig, **fwd_options)
+            assert list(eigvecs2.shape) == list([*submat.shape[:-1], neig])
+            assert torch.allclose(eigvals2, subeigvals)
 
-            gradcheck(lsymeig_fcn, (mat1,))
-            gradgradcheck(lsymeig_fcn, (mat1,))
+    # only perform gradcheck if neig is full, to reduce the computational cost
+    neig = shape[-1]
+
+    def lsymeig_fcn(amat):
+        amat = (amat + amat.transpose(-2, -1)) * 0.5  # symmetrize
+        alinop = LinearOperator.m(amat, is_hermitian=True)
+        eigvals_, eigvecs_ = lsymeig(alinop, neig=neig, **fwd_options)
+        return eigvals_, eigvecs_
+
+    gradcheck(lsymeig_fcn, (mat1,))
+    gradgradcheck(lsymeig_fcn, (mat1,))
 
 @device_dtype_float_test(only64=True, additional_kwargs={
-    "ashape": [(3, 3), (2, 3, 3), (2, 1, 3, 3)],
-    "mshape": [(3, 3), (2, 3, 3), (2, 1, 3, 3)],
     "method": ["exacteig", "custom_exacteig"],  # only 2 of methods, because both gradient implementations are covered
 })
-def test_lsymeig_AM(dtype, device, ashape, mshape, method):
+def test_lsymeig_AM(dtype, device, method):
+    # A and M have different batch shapes to check the broadcasting, the
+    # unbatched cases are covered as the slices of the batched one
     torch.manual_seed(seed)
+    ashape = (2, 1, 3, 3)
+    mshape = (2, 3, 3)
     mata = torch.rand(ashape, dtype=dtype, device=device)
     matm = torch.rand(mshape, dtype=dtype, device=device) + \
         torch.eye(mshape[-1], dtype=dtype, device=device)  # make sure it's not singular
@@ -103,22 +115,70 @@ def test_lsymeig_AM(dtype, device, ashape, mshape, method):
         assert list(eigvecs.shape) == list([*bshape, na, neig])
 
         ax = linopa.mm(eigvecs)
-        mxe = linopm.mm(torch.matmul(eigvecs, torch.diag_embed(eigvals, dim1=-2, dim2=-1)))
+        mxe = linopm.mm(eigvecs * eigvals.unsqueeze(-2))
         assert torch.allclose(ax, mxe)
 
-        # only perform gradcheck if neig is full, to reduce the computational cost
-        if neig == ashape[-1]:
-            def lsymeig_fcn(amat, mmat):
-                # symmetrize
-                amat = (amat + amat.transpose(-2, -1)) * 0.5
-                mmat = (mmat + mmat.transpose(-2, -1)) * 0.5
-                alinop = LinearOperator.m(amat, is_hermitian=True)
-                mlinop = LinearOperator.m(mmat, is_hermitian=True)
-                eigvals_, eigvecs_ = lsymeig(alinop, M=mlinop, neig=neig, **fwd_options)
-                return eigvals_, eigvecs_
+        # compare with the unbatched and lower rank batched matrices
+        subcases = [
+            (mata[1, 0], matm[0], eigvals[1, 0]),
+            (mata[1, 0], matm, eigvals[1]),
+            (mata[1], matm[1], eigvals[1, 1]),
+        ]
+        for submata, submatm, subeigvals in subcases:
+            eigvals2, eigvecs2 = lsymeig(LinearOperator.m(submata, True),
+                                         M=LinearOperator.m(submatm, True),
+                                         neig=neig, **fwd_options)
+            assert torch.allclose(eigvals2, subeigvals)
+
+    # only perform gradcheck if neig is full, to reduce the computational cost
+    neig = ashape[-1]
+
+    def lsymeig_fcn(amat, mmat):
+        # symmetrize
+        amat = (amat + amat.transpose(-2, -1)) * 0.5
+        mmat = (mmat + mmat.transpose(-2, -1)) * 0.5
+        alinop = LinearOperator.m(amat, is_hermitian=True)
+        mlinop = LinearOperator.m(mmat, is_hermitian=True)
+        eigvals_, eigvecs_ = lsymeig(alinop, M=mlinop, neig=neig, **fwd_options)
+        return eigvals_, eigvecs_
+
+    gradcheck(lsymeig_fcn, (mata, matm))
+    gradgradcheck(lsymeig_fcn, (mata, matm))
 
-            gradcheck(lsymeig_fcn, (mata, matm))
-            gradgradcheck(lsymeig_fcn, (mata, matm))
+@device_dtype_float_test(additional_kwargs={
+    "mode": ["lowest", "uppest"],
+    "with_m": [False, True],
+})
+def test_symeig_partial(dtype, device, mode, with_m):
+    # only a few eigenpairs are requested, so only those are computed
+    torch.manual_seed(seed)
+    na = 20
+    neig = 2
+    mata = torch.rand((2, 1, na, na), dtype=dtype, device=device)
+    mata = mata + mata.transpose(-2, -1)
+    linopa = LinearOperator.m(mata, True)
+    if with_m:
+        matm = torch.rand((3, na, na), dtype=dtype, device=device) * 0.1 + \
+            torch.eye(na, dtype=dtype, device=device)
+        matm = matm + matm.transpose(-2, -1)
+        linopm = LinearOperator.m(matm, True)
+    else:
+        linopm = None
+
+    eigvals, eigvecs = symeig(linopa, neig=neig, mode=mode, M=linopm)
+    eigvals_all, eigvecs_all = symeig(linopa, mode=mode, M=linopm)
+    bshape = [2, 3] if with_m else [2, 1]
+    assert list(eigvals.shape) == [*bshape, neig]
+    assert list(eigvecs.shape) == [*bshape, na, neig]
+
+    eigvals_true = eigvals_all[..., :neig] if mode == "lowest" else eigvals_all[..., -neig:]
+    rtol = 1e-4 if dtype == torch.float32 else 1e-6
+    assert torch.allclose(eigvals, eigvals_true, rtol=rtol)
+
+    ax = linopa.mm(eigvecs)
+    xe = eigvecs * eigvals.unsqueeze(-2)
+    mxe = linopm.mm(xe) if with_m else xe
+    assert torch.allclose(ax, mxe, rtol=rtol, atol=rtol)
 
 @device_dtype_float_test(only64=True, additional_kwargs={
     "shape": [(1000, 1000), (2, 1000, 1000), (2, 3, 1000, 1000)],
@@ -166,9 +226,50 @@ def test_symeig_A_large_methods(dtype, device, shape, method, mode):
     assert list(eigvals.shape) == list([*linop1.shape[:-2], neig])
 
     ax = linop1.mm(eigvecs)
-    xe = torch.matmul(eigvecs, torch.diag_embed(eigvals, dim1=-2, dim2=-1))
+    xe = eigvecs * eigvals.unsqueeze(-2)
     assert torch.allclose(ax, xe)
 
+@device_dtype_float_test(only64=True, additional_kwargs={
+    "with_m": [False, True],
+    "v_init": ["randn", "eye"],
+})
+def test_davidson_add_guess_vectors(dtype, device, with_m, v_init):
+    # check that AV is kept consistent with V as the guess vectors are added
+    torch.manual_seed(seed)
+    na = 20
+    nguess = 3
+    mat = torch.rand((2, na, na), dtype=dtype, device=device)
+    mat = mat + mat.transpose(-2, -1)
+    linop = LinearOperator.m(mat, True)
+    if with_m:
+        mmat = torch.rand((na, na), dtype=dtype, device=device) * 0.1 + \
+            torch.eye(na, dtype=dtype, device=device)
+        mmat = mmat + mmat.transpose(-2, -1)
+        mlinop = LinearOperator.m(mmat, True)
+    else:
+        mlinop = None
+
+    def assert_orthonormal(V):
+        MV = mlinop.mm(V) if with_m else V
+        eye = torch.eye(V.shape[-1], dtype=dtype, device=device)
+        assert torch.allclose(V.transpose(-2, -1) @ MV, eye.expand(2, *eye.shape))
+
+    V = _set_initial_v(v_init, dtype, device, (2,), na, nguess, M=mlinop)
+    assert list(V.shape) == [2, na, nguess]
+    assert_orthonormal(V)
+    AV = linop.mm(V)
+    MV = mlinop.mm(V) if with_m else None
+    for i in range(4):
+        t = torch.randn((2, na, nguess), dtype=dtype, device=device)
+        V, AV, MV = _add_guess_vectors(linop, V, AV, t, M=mlinop, MV=MV)
+        assert V.shape[-1] == nguess * (i + 2)
+        assert torch.allclose(AV, linop.mm(V))
+        if with_m:
+            assert torch.allclose(MV, mlinop.mm(V))
+        else:
+            assert MV is None
+        assert_orthonormal(V)
+
 ############## svd #############
 @device_dtype_float_test(only64=True, additional_kwargs={
     "shape": [(4, 3), (2, 1, 3, 4)],
@@ -193,7 +294,7 @@ def test_svd_A(dtype, device, shape, method):
         assert torch.allclose(u.transpose(-2, -1) @ u, keye)
         assert torch.allclose(vh @ vh.transpose(-2, -1), keye)
         if k == min_mn:
-            assert torch.allclose(mat1, u @ torch.diag_embed(s) @ vh)
+            assert torch.allclose(mat1, (u * s.unsqueeze(-2)) @ vh)
 
         def svd_fcn(amat, only_s=False):
             alinop = LinearOperator.m(amat, is_hermitian=False)
@@ -380,7 +481,7 @@ def test_solve_AE(dtype, device, ashape, bshape, eshape, method):
     assert list(x.shape) == xshape
 
     ax = LinearOperator.m(amat).mm(x)
-    xe = torch.matmul(x, torch.diag_embed(emat, dim2=-1, dim1=-2))
+    xe = x * emat.unsqueeze(-2)
     assert torch.allclose(ax - xe, bmat)
 
     # grad check only performed at AEM, to save time
@@ -434,7 +535,7 @@ def test_solve_AEM(dtype, device, abeshape, mshape, method):
     assert list(x.shape) == xshape
 
     ax = LinearOperator.m(amat).mm(x)
-    mxe = LinearOperator.m(mmat).mm(torch.matmul(x, torch.diag_embed(emat, dim2=-1, dim1=-2)))
+    mxe = LinearOperator.m(mmat).mm(x * emat.unsqueeze(-2))
     y = ax - mxe
     assert torch.allclose(y, bmat)
 
@@ -485,5 +586,5 @@ def test_solve_AEM_methods(dtype, device, method):
 
     x = solvefcn(amat, bmat, emat, mmat)
     ax = LinearOperator.m(amat).mm(x)
-    mxe = LinearOperator.m(mmat).mm(x) @ torch.diag_embed(emat)
+    mxe = LinearOperator.m(mmat).mm(x) * emat.unsqueeze(-2)
     assert torch.allclose(ax - mxe, bmat)
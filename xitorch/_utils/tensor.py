@@ -13,9 +13,9 @@ def tallqr(V, MV=None):
     if MV is None:
         MV = V
     VTV = torch.matmul(V.transpose(-2, -1), MV)  # (*BMV, nguess, nguess)
-    R = torch.cholesky(VTV, upper=True)  # (*BMV, nguess, nguess)
-    Rinv = torch.inverse(R)  # (*BMV, nguess, nguess)
-    Q = torch.matmul(V, Rinv)
+    R = torch.linalg.cholesky(VTV).transpose(-2, -1)  # (*BMV, nguess, nguess)
+    # Q = V R^{-1}, solved without explicitly inverting R
+    Q = torch.linalg.solve_triangular(R, V, upper=True, left=False)
     return Q, R
 
 def to_fortran_order(V):